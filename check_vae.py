@@ -10,10 +10,13 @@ VAE训练检查工具 - 现代化版本
 - 架构兼容性检查
 """
 
+import sys
+import random
 import torch
-import numpy as np
-import matplotlib.pyplot as plt
 from pathlib import Path
+from PIL import Image
+from torch.utils.data import DataLoader, Subset
+from torchvision.utils import make_grid
 from diffusers import AutoencoderKL
 from utils.data_loader import MicroDopplerDataset
 import argparse
@@ -21,22 +24,94 @@ import argparse
 class VAEChecker:
     """VAE检查器"""
 
-    def __init__(self, output_dir="/kaggle/working/outputs", data_dir="/kaggle/input/dataset"):
+    def __init__(self, output_dir="/kaggle/working/outputs", data_dir="/kaggle/input/dataset",
+                 compile_model=False):
         self.output_dir = Path(output_dir)
         self.data_dir = data_dir
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        # torch.compile默认关闭: 每个检查阶段对每种批次形状只调用一次编码/解码，
+        # 编译和CUDA Graph预热的开销无法被后续调用摊销；只在GPU上可选启用 (CUDA Graphs需要CUDA)
+        self.compile_model = compile_model and self.device == "cuda" and hasattr(torch, "compile")
+
+        # 已加载的VAE缓存 (避免各检查阶段重复加载/编译)
+        self._vae = None
+        self._vae_path = None
+        self._available_models = None
+        self._dataset = None
+
+    def _compile_vae(self, vae):
+        """编译VAE编码器/解码器 (仅 --compile 时使用)"""
+        torch.set_float32_matmul_precision("high")
+        # 编译内部的encoder/decoder模块而不是vae.encode/vae.decode方法，
+        # 避开Diffusers AutoencoderKL包装方法的编译问题
+        # dynamic=False: 按输入形状特化，每种(B, 3, 128, 128)批次各编译一张图。
+        # 一次检查中每种形状只调用一次，CUDA Graph不会被重放，编译开销无法摊销
+        vae.encoder = torch.compile(vae.encoder, mode="reduce-overhead", dynamic=False)
+        vae.decoder = torch.compile(vae.decoder, mode="reduce-overhead", dynamic=False)
+        print("   ⚡ 已启用torch.compile (reduce-overhead)")
+        return vae
+
+    def _to_device(self, images):
+        """把输入批次移到设备上 (GPU上使用channels_last布局)"""
+        if self.device == "cuda":
+            return images.to(self.device, memory_format=torch.channels_last, non_blocking=True)
+        return images.to(self.device)
+
+    def _get_dataset(self):
+        """获取检查用数据集 (各检查阶段共享，只扫描一次数据目录)"""
+        if self._dataset is None:
+            self._dataset = MicroDopplerDataset(
+                data_dir=self.data_dir,
+                resolution=128,  # 更新为128×128匹配新训练配置
+                augment=False,
+                split="test"
+            )
+        return self._dataset
+
+    def _load_batch(self, dataset, indices):
+        """
+        用DataLoader读取/解码选中的样本，作为一个批次返回
+
+        所有样本组成同一个批次 (只有4-8张)，多进程也只会由一个worker读取，
+        启动worker进程反而比解码更慢，因此直接在主进程中读取。
+        """
+        loader = DataLoader(
+            Subset(dataset, indices),
+            batch_size=len(indices),
+            shuffle=False,
+            num_workers=0,
+            pin_memory=self.device == "cuda"
+        )
+        batch = next(iter(loader))
+        return self._to_device(batch['image'])
+
+    def _autocast(self):
+        """推理用的FP16自动混合精度 (仅GPU，T4等有FP16 Tensor Core)"""
+        return torch.autocast(device_type="cuda", dtype=torch.float16,
+                              enabled=self.device == "cuda")
+
+    @staticmethod
+    def _psnr(mse):
+        """PSNR = 20*log10(1/sqrt(MSE)) = -10*log10(MSE)，MSE为0时为inf"""
+        return -10 * torch.log10(mse)
+
+    def find_models(self):
+        """查找所有可用模型 (只扫描一次目录并缓存结果)"""
+        if self._available_models is None:
+            if not self.output_dir.exists():
+                self._available_models = []
+            else:
+                # 一次glob即可找到 <训练目录>/final_model/config.json，无需逐个exists()
+                self._available_models = sorted(
+                    config_file.parent
+                    for config_file in self.output_dir.glob("*/final_model/config.json")
+                )
+        return self._available_models
 
     def find_model(self):
-        """查找可用模型"""
-        if not self.output_dir.exists():
-            return None
-
-        for train_dir in self.output_dir.iterdir():
-            if train_dir.is_dir():
-                final_model = train_dir / "final_model"
-                if final_model.exists() and (final_model / "config.json").exists():
-                    return final_model
-        return None
+        """查找第一个可用模型"""
+        models = self.find_models()
+        return models[0] if models else None
 
     def load_model(self, model_path=None):
         """加载VAE模型"""
@@ -47,16 +122,26 @@ class VAEChecker:
             print("❌ 未找到可用模型")
             return None
 
+        # 同一路径的模型已加载则直接复用
+        if self._vae is not None and self._vae_path == str(model_path):
+            print(f"♻️  复用已加载模型: {model_path}")
+            return self._vae
+
         try:
             print(f"🔄 加载模型: {model_path}")
             vae = AutoencoderKL.from_pretrained(str(model_path))
             vae = vae.to(self.device).eval()
+            if self.device == "cuda":
+                # NHWC布局让cuDNN选择更高效的卷积kernel
+                vae = vae.to(memory_format=torch.channels_last)
 
             # 测试前向传播 (使用128×128匹配新训练配置)
-            test_input = torch.randn(1, 3, 128, 128).to(self.device)
-            with torch.no_grad():
+            # 在编译之前以eager模式运行: 编译使用dynamic=False，每个输入形状会单独
+            # 编译一次，B=1的形状之后不再使用，不应为它额外编译
+            test_input = self._to_device(torch.randn(1, 3, 128, 128))
+            with torch.no_grad(), self._autocast():
                 posterior = vae.encode(test_input).latent_dist
-                latent = posterior.sample()
+                latent = posterior.mean
                 _ = vae.decode(latent).sample
 
             total_params = sum(p.numel() for p in vae.parameters())
@@ -73,6 +158,11 @@ class VAEChecker:
                 print(f"   ⚠️  架构警告: 潜在空间{latent.shape}，期望{expected_latent_shape}")
                 print(f"   💡 可能是旧版本模型，建议重新训练")
 
+            if self.compile_model:
+                vae = self._compile_vae(vae)
+
+            self._vae = vae
+            self._vae_path = str(model_path)
             return vae
 
         except Exception as e:
@@ -89,63 +179,49 @@ class VAEChecker:
                 return None
 
         try:
-            dataset = MicroDopplerDataset(
-                data_dir=self.data_dir,
-                resolution=128,  # 更新为128×128匹配新训练配置
-                augment=False,
-                split="test"
-            )
-
-            indices = torch.randperm(len(dataset))[:num_samples]
-            mse_scores = []
+            dataset = self._get_dataset()
 
-            # 创建简单的对比图
-            plt.figure(figsize=(num_samples * 3, 6))
+            # 只需要少量不重复的索引，不必对整个数据集做randperm
+            indices = random.sample(range(len(dataset)), min(num_samples, len(dataset)))
+            num_samples = len(indices)
 
+            # 一次性批量编码/解码所有样本 (避免逐张B=1推理)
             with torch.no_grad():
-                for i, idx in enumerate(indices):
-                    sample = dataset[idx]
-                    original = sample['image'].unsqueeze(0).to(self.device)
-
-                    # VAE重建
-                    posterior = vae.encode(original).latent_dist
-                    latent = posterior.sample()
-                    reconstructed = vae.decode(latent).sample
-
-                    # 转换为numpy并计算指标
-                    orig_np = original.squeeze().cpu().numpy().transpose(1, 2, 0)
-                    recon_np = reconstructed.squeeze().cpu().numpy().transpose(1, 2, 0)
-                    orig_np = np.clip(orig_np, 0, 1)
-                    recon_np = np.clip(recon_np, 0, 1)
-
-                    mse = np.mean((orig_np - recon_np) ** 2)
-                    psnr = 20 * np.log10(1.0 / np.sqrt(mse)) if mse > 0 else float('inf')
-                    mse_scores.append(mse)
-
-                    # 显示原始图像
-                    plt.subplot(2, num_samples, i + 1)
-                    plt.imshow(orig_np)
-                    plt.title(f'原始 {i+1}', fontsize=10)
-                    plt.axis('off')
-
-                    # 显示重建图像
-                    plt.subplot(2, num_samples, i + 1 + num_samples)
-                    plt.imshow(recon_np)
-                    plt.title(f'重建 {i+1}\nPSNR: {psnr:.1f}dB', fontsize=10)
-                    plt.axis('off')
-
-                    print(f"   ✅ 样本 {i+1}: PSNR={psnr:.1f}dB")
-
-            plt.suptitle('VAE重建质量检查', fontsize=14)
-            plt.tight_layout()
-
+                originals = self._load_batch(dataset, indices)
+
+                with self._autocast():
+                    posterior = vae.encode(originals).latent_dist
+                    # 重建质量评估不需要随机性，直接使用后验均值
+                    latents = posterior.mean
+                    reconstructed = vae.decode(latents).sample
+                # 指标统计回到FP32，避免半精度噪声
+                reconstructed = reconstructed.float()
+
+                # 在GPU上一次性计算每个样本的MSE/PSNR和总体指标
+                originals = originals.clamp(0, 1)
+                reconstructed = reconstructed.clamp(0, 1)
+                mse_scores = ((originals - reconstructed) ** 2).mean(dim=(1, 2, 3))
+                mse_all = torch.cat([mse_scores, mse_scores.mean().unsqueeze(0)])
+                psnr_all = self._psnr(mse_all)
+
+                # 只在最后做一次设备到主机的同步
+                stats = torch.stack([mse_all, psnr_all]).cpu().tolist()
+                psnr_scores = stats[1][:num_samples]
+                avg_mse, avg_psnr = stats[0][-1], stats[1][-1]
+
+                # 在GPU上拼接 原始/重建/误差 三行对比图，一次性转为uint8
+                diff = (originals - reconstructed).abs()
+                grid = make_grid(torch.cat([originals, reconstructed, diff], dim=0),
+                                 nrow=num_samples, padding=2)
+                grid = grid.mul(255).clamp_(0, 255).byte().permute(1, 2, 0).cpu().numpy()
+
+            for i in range(num_samples):
+                print(f"   ✅ 样本 {i+1}: PSNR={psnr_scores[i]:.1f}dB")
+
+            # 对比图: 第1行原始, 第2行重建, 第3行绝对误差
             save_path = "/kaggle/working/vae_reconstruction.png"
-            plt.savefig(save_path, dpi=150, bbox_inches='tight')
-            plt.show()
-
-            # 计算总体指标
-            avg_mse = np.mean(mse_scores)
-            avg_psnr = 20 * np.log10(1.0 / np.sqrt(avg_mse)) if avg_mse > 0 else float('inf')
+            Image.fromarray(grid).save(save_path)
+            print(f"   🖼️  对比图已保存: {save_path} (原始/重建/误差)")
 
             print(f"\n📊 重建质量指标:")
             print(f"   平均MSE: {avg_mse:.6f}")
@@ -200,59 +276,65 @@ class VAEChecker:
         if vae is None:
             return
 
+        # 只有对比图需要matplotlib，延迟导入以缩短 --mode check 的启动时间
+        import matplotlib
+        if "matplotlib.pyplot" not in sys.modules:
+            matplotlib.use("Agg")  # 只保存文件，不探测图形界面后端
+        import matplotlib.pyplot as plt
+
         try:
-            dataset = MicroDopplerDataset(
-                data_dir=self.data_dir,
-                resolution=128,  # 更新为128×128匹配新训练配置
-                augment=False,
-                split="test"
-            )
+            dataset = self._get_dataset()
 
-            indices = torch.randperm(len(dataset))[:num_samples]
+            # 只需要少量不重复的索引，不必对整个数据集做randperm
+            indices = random.sample(range(len(dataset)), min(num_samples, len(dataset)))
             output_dir = Path("/kaggle/working/comparisons")
             output_dir.mkdir(exist_ok=True)
 
+            # 批量编码/解码，然后一次性拷贝回主机
             with torch.no_grad():
-                for i, idx in enumerate(indices):
-                    sample = dataset[idx]
-                    original = sample['image'].unsqueeze(0).to(self.device)
+                originals = self._load_batch(dataset, indices)
+
+                with self._autocast():
+                    posterior = vae.encode(originals).latent_dist
+                    latents = posterior.mean
+                    reconstructed = vae.decode(latents).sample
+                reconstructed = reconstructed.float()
 
-                    # VAE重建
-                    posterior = vae.encode(original).latent_dist
-                    latent = posterior.sample()
-                    reconstructed = vae.decode(latent).sample
+                # 在GPU上裁剪并计算每个样本的PSNR
+                originals = originals.clamp(0, 1)
+                reconstructed = reconstructed.clamp(0, 1)
+                mse_scores = ((originals - reconstructed) ** 2).mean(dim=(1, 2, 3))
+                psnr_scores = self._psnr(mse_scores).cpu().tolist()
 
-                    # 转换为numpy
-                    orig_np = original.squeeze().cpu().numpy().transpose(1, 2, 0)
-                    recon_np = reconstructed.squeeze().cpu().numpy().transpose(1, 2, 0)
-                    orig_np = np.clip(orig_np, 0, 1)
-                    recon_np = np.clip(recon_np, 0, 1)
+            orig_batch = originals.cpu().numpy().transpose(0, 2, 3, 1)
+            recon_batch = reconstructed.cpu().numpy().transpose(0, 2, 3, 1)
 
-                    # 计算PSNR
-                    mse = np.mean((orig_np - recon_np) ** 2)
-                    psnr = 20 * np.log10(1.0 / np.sqrt(mse)) if mse > 0 else float('inf')
+            for i, idx in enumerate(indices):
+                orig_np = orig_batch[i]
+                recon_np = recon_batch[i]
+                psnr = psnr_scores[i]
 
-                    # 创建对比图
-                    plt.figure(figsize=(10, 5))
+                # 创建对比图
+                plt.figure(figsize=(10, 5))
 
-                    plt.subplot(1, 2, 1)
-                    plt.imshow(orig_np)
-                    plt.title(f'原始图像 (Sample: {idx})', fontsize=14)
-                    plt.axis('off')
+                plt.subplot(1, 2, 1)
+                plt.imshow(orig_np)
+                plt.title(f'原始图像 (Sample: {idx})', fontsize=14)
+                plt.axis('off')
 
-                    plt.subplot(1, 2, 2)
-                    plt.imshow(recon_np)
-                    plt.title(f'重建图像 (PSNR: {psnr:.1f}dB)', fontsize=14)
-                    plt.axis('off')
+                plt.subplot(1, 2, 2)
+                plt.imshow(recon_np)
+                plt.title(f'重建图像 (PSNR: {psnr:.1f}dB)', fontsize=14)
+                plt.axis('off')
 
-                    plt.suptitle(f'VAE重建对比 - 样本 {i+1}', fontsize=16)
-                    plt.tight_layout()
+                plt.suptitle(f'VAE重建对比 - 样本 {i+1}', fontsize=16)
+                plt.tight_layout()
 
-                    save_path = output_dir / f"comparison_{i+1:02d}.png"
-                    plt.savefig(save_path, dpi=150, bbox_inches='tight')
-                    plt.close()
+                save_path = output_dir / f"comparison_{i+1:02d}.png"
+                plt.savefig(save_path, dpi=150, bbox_inches='tight')
+                plt.close()
 
-                    print(f"   ✅ 样本 {i+1}: PSNR={psnr:.1f}dB → {save_path.name}")
+                print(f"   ✅ 样本 {i+1}: PSNR={psnr:.1f}dB → {save_path.name}")
 
             print(f"\n📁 对比图保存在: {output_dir}")
 
@@ -272,10 +354,12 @@ def main():
                        help="数据目录路径")
     parser.add_argument("--num_samples", type=int, default=8,
                        help="样本数量")
+    parser.add_argument("--compile", action="store_true",
+                       help="启用torch.compile (默认关闭: 检查阶段每种批次只调用一次，编译开销无法摊销)")
 
     args = parser.parse_args()
 
-    checker = VAEChecker(args.output_dir, args.data_dir)
+    checker = VAEChecker(args.output_dir, args.data_dir, compile_model=args.compile)
 
     if args.mode == "compare":
         checker.create_simple_comparison(args.num_samples)
@@ -5,6 +5,7 @@
 """
 
 import os
+import re
 import torch
 import numpy as np
 from PIL import Image
@@ -23,6 +24,9 @@ sys.path.insert(0, str(project_root))
 
 from training.train_diffusion import UserConditionEncoder
 
+# 用户数据目录名: ID_<数字> (可带后缀 ID_<数字>_xxx)
+USER_DIR_PATTERN = re.compile(r'^ID_(\d+)(?:_|$)')
+
 def generate_images_training_style(
     vae_path: str,
     unet_path: str,
@@ -67,18 +71,15 @@ def generate_images_training_style(
     user_id_to_idx = {}
     if data_dir is not None:
         print("🔍 获取训练时的用户ID映射...")
-        from pathlib import Path
-        data_path = Path(data_dir)
         all_users = []
 
         # 扫描数据目录，获取所有用户ID (与训练时逻辑一致)
-        for user_dir in data_path.iterdir():
-            if user_dir.is_dir() and user_dir.name.startswith('ID_'):
-                try:
-                    user_id = int(user_dir.name.split('_')[1])
-                    all_users.append(user_id)
-                except ValueError:
-                    continue
+        # os.scandir 直接使用目录项类型信息，无需对每个条目单独stat
+        with os.scandir(data_dir) as entries:
+            for entry in entries:
+                match = USER_DIR_PATTERN.match(entry.name)
+                if match and entry.is_dir():
+                    all_users.append(int(match.group(1)))
 
         # 排序并创建映射 (与训练时逻辑一致)
         all_users = sorted(all_users)
@@ -6,7 +6,7 @@ CelebA标准微多普勒VAE训练器
 
 import os
 import sys
-import subprocess
+import traceback
 import torch
 from pathlib import Path
 
@@ -16,7 +16,7 @@ def setup_celeba_environment():
     os.environ['CUDA_VISIBLE_DEVICES'] = '0'
     
     # 优化内存分配
-    os.environ['PYTORCH_CUDA_ALLOC_CONF'] = 'max_split_size_mb:256'
+    os.environ['PYTORCH_CUDA_ALLOC_CONF'] = 'expandable_segments:True'  # 可扩展显存段，减少碎片
     os.environ['PYTHONUNBUFFERED'] = '1'
     
     # 基础优化
@@ -75,9 +75,8 @@ def launch_celeba_training():
 
     print(f"\n🚀 启动VAE训练 (批次:{config['batch_size']}, 精度:{config['mixed_precision']})")
     
-    cmd = [
-        "python", "-u",
-        "training/train_vae.py",
+    # 训练参数 (直接传给 training/train_vae.py 的 main)
+    train_args = [
         "--data_dir", "/kaggle/input/dataset",
         "--output_dir", "/kaggle/working/outputs/vae_celeba_standard",
         "--batch_size", str(config["batch_size"]),
@@ -95,6 +94,10 @@ def launch_celeba_training():
         "--sample_interval", "50",
         "--experiment_name", "micro_doppler_celeba_standard"
     ]
+
+    # fp16下使用channels_last (NHWC) 布局，cuDNN卷积可走Tensor Core路径
+    if config["mixed_precision"] == "fp16":
+        train_args.append("--channels_last")
     
     print(f"📊 CelebA标准配置:")
     # 有效批次大小
@@ -105,30 +108,29 @@ def launch_celeba_training():
     print(f"🖼️  模式: 普通图像训练 (禁用频域损失)")
     
     try:
-        # 启动训练
-        process = subprocess.Popen(
-            cmd,
-            stdout=None,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-            bufsize=0
-        )
-        
-        return_code = process.wait()
-        
-        if return_code == 0:
-            print(f"\n✅ VAE训练完成!")
-            return True
-        else:
-            print(f"\n❌ 训练失败 (退出码: {return_code})")
-            return False
+        # 在当前进程内启动训练，复用已加载的PyTorch和CUDA上下文，
+        # 避免子进程重新启动Python解释器并重新初始化CUDA
+        project_root = Path(__file__).parent
+        sys.path.insert(0, str(project_root))
+        from training.train_vae import main as train_main
+
+        train_main(train_args)
+
+        print(f"\n✅ VAE训练完成!")
+        return True
 
     except KeyboardInterrupt:
         print("\n⚠️  训练被用户中断")
-        process.terminate()
+        return False
+    except SystemExit as e:
+        # 进程内调用时，参数解析错误会以SystemExit退出，同样按训练失败处理
+        if e.code in (0, None):
+            return True
+        print(f"\n❌ 训练失败: 训练脚本退出 (退出码 {e.code})")
         return False
     except Exception as e:
-        print(f"\n❌ 训练启动失败: {e}")
+        print(f"\n❌ 训练失败: {e}")
+        traceback.print_exc()
         return False
 
 def main():
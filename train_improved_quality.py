@@ -6,14 +6,14 @@
 
 import os
 import sys
-import subprocess
+import traceback
 import torch
 from pathlib import Path
 
 def setup_environment():
     """设置环境"""
     os.environ['CUDA_VISIBLE_DEVICES'] = '0'
-    os.environ['PYTORCH_CUDA_ALLOC_CONF'] = 'max_split_size_mb:256'
+    os.environ['PYTORCH_CUDA_ALLOC_CONF'] = 'expandable_segments:True'  # 可扩展显存段，减少碎片
     os.environ['PYTHONUNBUFFERED'] = '1'
     torch.backends.cudnn.benchmark = True
 
@@ -73,9 +73,8 @@ def launch_improved_training():
     print(f"🖼️  模式: 现代化高质量训练 (Lanczos缩放)")
     
     # 构建命令
-    cmd = [
-        "python", 
-        "training/train_vae.py",
+    # 训练参数 (直接传给 training/train_vae.py 的 main)
+    train_args = [
         "--data_dir", "/kaggle/input/dataset",
         "--output_dir", "/kaggle/working/outputs/vae_improved_quality",
         "--batch_size", str(config["batch_size"]),
@@ -100,6 +99,10 @@ def launch_improved_training():
         "--latent_channels", "4",                                        # 保持4通道
         "--sample_size", "128",                                          # 修复: 设置sample_size为128匹配输入尺寸
     ]
+
+    # fp16下使用channels_last (NHWC) 布局，cuDNN卷积可走Tensor Core路径
+    if config["mixed_precision"] == "fp16":
+        train_args.append("--channels_last")
     
     print(f"\n🏗️  现代化架构 (128×128 → 32×32):")
     print(f"   📐 输入: 128×128×3 = 49,152 像素")
@@ -119,30 +122,29 @@ def launch_improved_training():
     print(f"   🔍 细节保留: 显著提升")
     
     try:
-        # 启动训练
-        process = subprocess.Popen(
-            cmd,
-            stdout=None,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-            bufsize=0
-        )
-        
-        return_code = process.wait()
-        
-        if return_code == 0:
-            print(f"\n✅ 改进VAE训练完成!")
-            return True
-        else:
-            print(f"\n❌ 训练失败 (退出码: {return_code})")
-            return False
-            
+        # 在当前进程内启动训练，复用已加载的PyTorch和CUDA上下文，
+        # 避免子进程重新启动Python解释器并重新初始化CUDA
+        project_root = Path(__file__).parent
+        sys.path.insert(0, str(project_root))
+        from training.train_vae import main as train_main
+
+        train_main(train_args)
+
+        print(f"\n✅ 改进VAE训练完成!")
+        return True
+
     except KeyboardInterrupt:
         print("\n⚠️  训练被用户中断")
-        process.terminate()
+        return False
+    except SystemExit as e:
+        # 进程内调用时，参数解析错误会以SystemExit退出，同样按训练失败处理
+        if e.code in (0, None):
+            return True
+        print(f"\n❌ 训练失败: 训练脚本退出 (退出码 {e.code})")
         return False
     except Exception as e:
-        print(f"\n❌ 训练启动失败: {e}")
+        print(f"\n❌ 训练失败: {e}")
+        traceback.print_exc()
         return False
 
 def main():
@@ -209,6 +209,11 @@ def train_vae(args):
         norm_num_groups=32,
         scaling_factor=0.18215,
     )
+
+    # channels_last (NHWC) 布局，配合fp16让cuDNN卷积走Tensor Core路径
+    if args.channels_last:
+        vae = vae.to(memory_format=torch.channels_last)
+        print("✅ 已启用channels_last内存格式")
     
     # 创建数据集和数据加载器
     dataset = MicroDopplerDataset(
@@ -217,12 +222,19 @@ def train_vae(args):
         augment=args.use_augmentation
     )
     
+    # 多进程预取: persistent_workers避免每个epoch重建worker，
+    # prefetch_factor让worker提前准备批次，数据解码与GPU计算重叠
+    loader_kwargs = {}
+    if args.num_workers > 0:
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=2)
+
     dataloader = DataLoader(
         dataset,
         batch_size=args.batch_size,
         shuffle=True,
         num_workers=args.num_workers,
-        pin_memory=True
+        pin_memory=True,
+        **loader_kwargs
     )
     
     # 创建优化器
@@ -268,7 +280,8 @@ def train_vae(args):
     
     for epoch in range(args.num_epochs):
         vae.train()
-        epoch_loss = 0.0
+        # 在设备上累积损失，避免每步loss.item()强制CPU-GPU同步
+        epoch_loss = torch.zeros((), device=accelerator.device)
         
         progress_bar = tqdm(
             dataloader,
@@ -283,63 +296,71 @@ def train_vae(args):
             with accelerator.accumulate(vae):
                 # 获取图像数据
                 images = batch['image']  # [B, C, H, W]
+                if args.channels_last:
+                    images = images.to(memory_format=torch.channels_last)
                 
                 # VAE前向传播 (处理分布式训练)
                 # 在分布式训练中，需要通过.module访问原始模型
                 vae_model = vae.module if hasattr(vae, 'module') else vae
 
-                posterior = vae_model.encode(images).latent_dist
-                latents = posterior.sample()
-                reconstruction = vae_model.decode(latents).sample
-                
-                # 计算损失
-                loss_dict = loss_fn(reconstruction, images, posterior)
+                # 直接调用encode/decode会绕过accelerator对forward的autocast包装，
+                # 这里显式进入autocast，让--mixed_precision fp16/bf16真正生效
+                with accelerator.autocast():
+                    posterior = vae_model.encode(images).latent_dist
+                    latents = posterior.sample()
+                    reconstruction = vae_model.decode(latents).sample
+
+                # 计算损失 (在autocast之外以FP32进行: autocast不会提升FFT，
+                # FP16下的fft2/abs支持有限；KL中的exp(logvar)在FP16下也可能溢出)
+                posterior_fp32 = type(posterior)(posterior.parameters.float())
+                loss_dict = loss_fn(reconstruction.float(), images, posterior_fp32)
                 loss = loss_dict['total_loss']
                 
-                # 反向传播
+                # 反向传播 (fp16时accelerator内部使用GradScaler缩放损失)
                 accelerator.backward(loss)
                 
                 if accelerator.sync_gradients:
                     accelerator.clip_grad_norm_(vae.parameters(), args.max_grad_norm)
                 
                 optimizer.step()
-                optimizer.zero_grad()
-
-                # 定期清理GPU缓存
-                if global_step % 50 == 0 and torch.cuda.is_available():
-                    torch.cuda.empty_cache()
+                optimizer.zero_grad(set_to_none=True)
+                # 注意: 不在训练循环中调用torch.cuda.empty_cache()
+                # 缓存分配器会复用显存块，频繁释放只会导致每步重新cudaMalloc
 
             # 更新进度条
             if accelerator.sync_gradients:
                 global_step += 1
-                epoch_loss += loss.item()
+                epoch_loss += loss.detach()
                 
-                # 记录日志
+                # 记录日志 (只在日志步才把标量同步回CPU)
                 if global_step % args.log_interval == 0:
-                    avg_loss = epoch_loss / (step + 1)
+                    avg_loss = epoch_loss.item() / (step + 1)
                     
                     # 安全获取损失值（处理tensor和float）
                     def safe_item(value):
                         return value.item() if hasattr(value, 'item') else value
 
+                    loss_values = {name: safe_item(value) for name, value in loss_dict.items()}
+                    current_lr = lr_scheduler.get_last_lr()[0]
+
                     logs = {
                         "epoch": epoch,
                         "step": global_step,
-                        "lr": lr_scheduler.get_last_lr()[0],
-                        "loss/total": loss_dict['total_loss'].item(),
-                        "loss/recon": loss_dict['recon_loss'].item(),
-                        "loss/kl": loss_dict['kl_loss'].item(),
-                        "loss/perceptual": safe_item(loss_dict['perceptual_loss']),
-                        "loss/freq": safe_item(loss_dict['freq_loss']),
+                        "lr": current_lr,
+                        "loss/total": loss_values['total_loss'],
+                        "loss/recon": loss_values['recon_loss'],
+                        "loss/kl": loss_values['kl_loss'],
+                        "loss/perceptual": loss_values['perceptual_loss'],
+                        "loss/freq": loss_values['freq_loss'],
                     }
                     
                     # 更新进度条显示
                     progress_bar.set_postfix({
                         'loss': f"{avg_loss:.4f}",
-                        'recon': f"{loss_dict['recon_loss'].item():.4f}",
-                        'kl': f"{loss_dict['kl_loss'].item():.6f}",
-                        'freq': f"{safe_item(loss_dict['freq_loss']):.4f}",
-                        'lr': f"{lr_scheduler.get_last_lr()[0]:.2e}"
+                        'recon': f"{loss_values['recon_loss']:.4f}",
+                        'kl': f"{loss_values['kl_loss']:.6f}",
+                        'freq': f"{loss_values['freq_loss']:.4f}",
+                        'lr': f"{current_lr:.2e}"
                     })
                     
                     if args.use_wandb and accelerator.is_main_process:
@@ -435,7 +456,8 @@ def save_final_model(model, output_dir):
     model_to_save = model.module if hasattr(model, 'module') else model
     model_to_save.save_pretrained(Path(output_dir) / "final_model")
 
-def main():
+def main(argv=None):
+    """命令行入口；argv为None时解析sys.argv，也可由启动脚本在进程内直接传入参数列表"""
     parser = argparse.ArgumentParser(description="Train VAE for Micro-Doppler Images")
     
     # 数据参数
@@ -468,8 +490,10 @@ def main():
 
     # 系统参数
     parser.add_argument("--num_workers", type=int, default=4, help="数据加载器工作进程数")
-    parser.add_argument("--mixed_precision", type=str, default="fp16", help="混合精度")
+    parser.add_argument("--mixed_precision", type=str, default="fp16", choices=["no", "fp16", "bf16"],
+                       help="混合精度 (fp16: T4/P100; bf16: Ampere及以上)")
     parser.add_argument("--gradient_accumulation_steps", type=int, default=1, help="梯度累积步数")
+    parser.add_argument("--channels_last", action="store_true", help="使用channels_last内存格式 (配合fp16更快)")
     
     # 日志和保存
     parser.add_argument("--output_dir", type=str, default="./outputs/vae", help="输出目录")
@@ -480,7 +504,7 @@ def main():
     parser.add_argument("--use_wandb", action="store_true", help="使用wandb记录")
     parser.add_argument("--seed", type=int, default=42, help="随机种子")
     
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     
     # 开始训练
     train_vae(args)
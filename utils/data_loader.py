@@ -14,6 +14,9 @@ import torchvision.transforms as transforms
 import json
 from typing import Dict, List, Optional, Tuple
 
+# 支持的图像文件后缀
+IMAGE_SUFFIXES = ('.png', '.jpg', '.jpeg', '.bmp')
+
 class MicroDopplerDataset(Dataset):
     """微多普勒时频图数据集"""
     
@@ -100,10 +103,8 @@ class MicroDopplerDataset(Dataset):
             if user_ids is not None and user_id not in user_ids:
                 continue
 
-            # 扫描用户目录下的图像文件
-            user_images = []
-            for ext in ['*.png', '*.jpg', '*.jpeg', '*.bmp']:
-                user_images.extend(user_dir.glob(ext))
+            # 扫描用户目录下的图像文件 (单次遍历目录，按后缀过滤)
+            user_images = [p for p in user_dir.iterdir() if p.suffix in IMAGE_SUFFIXES]
 
             if len(user_images) == 0:
                 print(f"Warning: No images found for user {user_id}")
@@ -5,6 +5,7 @@
 验证生成图像是否包含对应用户的特征信息
 """
 
+import os
 import torch
 import torch.nn as nn
 import torch.optim as optim
@@ -15,11 +16,23 @@ import numpy as np
 from PIL import Image
 from pathlib import Path
 import json
-from typing import List, Tuple, Dict
+from typing import List, Tuple, Dict, Optional
 from tqdm import tqdm
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 from datetime import datetime
 
+def list_image_files(directory, suffixes: Tuple[str, ...] = (".png", ".jpg")) -> List[str]:
+    """
+    单次遍历目录，列出指定后缀的图像文件路径
+
+    使用os.scandir一次读取目录项并按后缀过滤，
+    代替每种后缀各glob一遍并为每个文件创建Path对象。
+    """
+    with os.scandir(directory) as entries:
+        return [entry.path for entry in entries
+                if entry.name.endswith(suffixes) and entry.is_file()]
+
 class UserImageDataset(Dataset):
     """用户图像数据集"""
     
@@ -189,7 +202,8 @@ class UserValidationSystem:
         self.classifiers = {}
     
     def prepare_user_data(self, user_id: int, real_images_dir: str, other_users_dirs: List[str],
-                         max_samples_per_class: int = 500, negative_ratio: float = 3.0) -> Tuple[List[str], List[int]]:
+                         max_samples_per_class: int = 500, negative_ratio: float = 3.0,
+                         file_lists: Optional[Dict[str, List[str]]] = None) -> Tuple[List[str], List[int]]:
         """
         为指定用户准备训练数据
 
@@ -199,20 +213,27 @@ class UserValidationSystem:
             other_users_dirs: 其他用户图像目录列表
             max_samples_per_class: 正样本最大数量
             negative_ratio: 负样本与正样本的比例 (默认3:1)
+            file_lists: 可选，目录路径到图像文件列表的映射 (已缓存的扫描结果)，
+                提供时不再重新扫描目录；负样本仍在每次调用时重新采样
 
         Returns:
             (image_paths, labels): 图像路径列表和标签列表
         """
         image_paths = []
         labels = []
+
+        def _list_dir(directory: Path) -> List[str]:
+            if file_lists is not None and str(directory) in file_lists:
+                return list(file_lists[str(directory)])
+            return list_image_files(directory)
         
         # 正样本: 该用户的真实图像
         real_dir = Path(real_images_dir)
         if real_dir.exists():
-            real_images = list(real_dir.glob("*.png")) + list(real_dir.glob("*.jpg"))
+            real_images = _list_dir(real_dir)
             real_images = real_images[:max_samples_per_class]  # 限制样本数量
             
-            image_paths.extend([str(p) for p in real_images])
+            image_paths.extend(real_images)
             labels.extend([1] * len(real_images))
             
             print(f"  用户 {user_id} 正样本: {len(real_images)} 张")
@@ -228,7 +249,7 @@ class UserValidationSystem:
         for other_dir in other_users_dirs:
             other_path = Path(other_dir)
             if other_path.exists():
-                other_images = list(other_path.glob("*.png")) + list(other_path.glob("*.jpg"))
+                other_images = _list_dir(other_path)
                 all_negative_images.extend(other_images)
 
         # 随机采样负样本，确保代表性
@@ -240,7 +261,7 @@ class UserValidationSystem:
             print(f"  警告: 可用负样本({len(all_negative_images)})少于目标数量({max_negative_samples})")
 
         # 添加负样本
-        image_paths.extend([str(p) for p in selected_negative])
+        image_paths.extend(selected_negative)
         labels.extend([0] * len(selected_negative))
         negative_count = len(selected_negative)
         
@@ -433,7 +454,9 @@ class UserValidationSystem:
         return history
 
     def validate_generated_images(self, user_id: int, generated_images_dir: str,
-                                confidence_threshold: float = 0.8) -> Dict:
+                                confidence_threshold: float = 0.8,
+                                image_files: Optional[List[str]] = None,
+                                batch_size: int = 32) -> Dict:
         """
         验证生成图像是否包含用户特征
 
@@ -441,6 +464,8 @@ class UserValidationSystem:
             user_id: 用户ID
             generated_images_dir: 生成图像目录
             confidence_threshold: 置信度阈值 (>0.8算成功)
+            image_files: 预先列出的图像文件路径列表，提供时不再扫描目录
+            batch_size: 分类器推理的批次大小
 
         Returns:
             验证结果字典
@@ -451,11 +476,13 @@ class UserValidationSystem:
         print(f"\n🔍 验证用户 {user_id} 的生成图像...")
 
         # 加载生成图像
-        gen_dir = Path(generated_images_dir)
-        if not gen_dir.exists():
-            raise FileNotFoundError(f"生成图像目录不存在: {gen_dir}")
+        if image_files is None:
+            gen_dir = Path(generated_images_dir)
+            if not gen_dir.exists():
+                raise FileNotFoundError(f"生成图像目录不存在: {gen_dir}")
 
-        image_files = list(gen_dir.glob("*.png")) + list(gen_dir.glob("*.jpg"))
+            image_files = list_image_files(gen_dir)
+        image_files = [Path(p) for p in image_files]
         if not image_files:
             print(f"  警告: 未找到生成图像")
             return {}
@@ -465,7 +492,16 @@ class UserValidationSystem:
         # 准备数据
         image_paths = [str(p) for p in image_files]
         dataset = UserImageDataset(image_paths, [0] * len(image_paths), self.transform)
-        dataloader = DataLoader(dataset, batch_size=32, shuffle=False, num_workers=2)
+        # 多个worker并行解码图像；GPU上使用锁页内存，配合non_blocking拷贝，
+        # 主线程排队拷贝和前向后即可去取下一批，不必等待传输完成。
+        # (若图像量很大，可再用独立的torch.cuda.Stream预取下一批，
+        #  让传输与当前批的前向完全重叠；生成图像通常只有几百张，这里不需要)
+        # 图像不超过一个批次时 (如对照实验每组只有几张)，启动worker进程的开销比解码本身还大，
+        # 直接在主进程中读取
+        use_cuda = self.device.type == "cuda"
+        num_workers = 0 if len(image_paths) <= batch_size else min(4, os.cpu_count() or 1)
+        dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False,
+                                num_workers=num_workers, pin_memory=use_cuda)
 
         # 获取分类器
         model = self.classifiers[user_id]
@@ -477,7 +513,7 @@ class UserValidationSystem:
 
         with torch.no_grad():
             for images, _ in tqdm(dataloader, desc="验证生成图像"):
-                images = images.to(self.device)
+                images = images.to(self.device, non_blocking=use_cuda)
                 outputs = model(images)
 
                 # 计算概率和预测
@@ -548,9 +584,19 @@ class UserValidationSystem:
 
         print(f"✅ 用户 {user_id} 分类器已从 {load_path} 加载")
 
-    def plot_training_history(self, history: Dict, save_path: str = None):
-        """绘制训练历史"""
-        fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(12, 4))
+    def plot_training_history(self, history: Dict, save_path: str = None, show: bool = True):
+        """绘制训练历史
+
+        Args:
+            history: 训练历史
+            save_path: 图片保存路径
+            show: 是否显示图像；为False时不经过pyplot的全局状态，可在后台线程中调用
+        """
+        if show:
+            fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(12, 4))
+        else:
+            fig = Figure(figsize=(12, 4))
+            ax1, ax2 = fig.subplots(1, 2)
 
         # 损失曲线
         ax1.plot(history['train_loss'], label='Train Loss')
@@ -570,13 +616,14 @@ class UserValidationSystem:
         ax2.legend()
         ax2.grid(True)
 
-        plt.tight_layout()
+        fig.tight_layout()
 
         if save_path:
-            plt.savefig(save_path, dpi=150, bbox_inches='tight')
+            fig.savefig(save_path, dpi=150, bbox_inches='tight')
             print(f"📊 训练历史图已保存到: {save_path}")
 
-        plt.show()
+        if show:
+            plt.show()
 
     def generate_validation_report(self, results_list: List[Dict], save_path: str = None) -> str:
         """生成验证报告"""
@@ -5,21 +5,117 @@
 """
 
 import os
+# 可扩展显存段减少VAE/UNet与分类器切换后的碎片 (必须在任何CUDA操作之前设置)
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
 import sys
 import argparse
 import json
+import hashlib
+import gc
+import copy
+import atexit
+import functools
 import torch
 import numpy as np
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple
 from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
 
 # 添加项目根目录到Python路径
 current_dir = Path(__file__).parent
 project_root = current_dir.parent
 sys.path.insert(0, str(project_root))
 
-from validation.user_classifier import UserValidationSystem
+from validation.user_classifier import UserValidationSystem, list_image_files
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# 后台I/O线程池: 训练曲线绘制和结果JSON写入不阻塞GPU工作，退出前等待全部写完
+_io_pool = ThreadPoolExecutor(max_workers=2)
+atexit.register(_io_pool.shutdown, wait=True)
+
+def _dump_json(obj, path):
+    """保存JSON结果 (优先使用orjson，不可用时回退到标准库)"""
+    if ORJSON_AVAILABLE:
+        options = orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(obj, option=options, default=str))
+    else:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(obj, f, indent=2, ensure_ascii=False, default=str)
+
+@functools.lru_cache(maxsize=1)
+def _load_diffusion_models(vae_path: str, unet_path: str, condition_encoder_path: str,
+                           num_users: int, device: str, compile_model: bool):
+    """
+    加载VAE、UNet和条件编码器并完成推理前的准备
+
+    结果按参数缓存: 逐个目标用户运行验证时，后续用户直接复用显存中的模型，
+    不再重复from_pretrained。只保留最近一组模型，模型路径或配置变化时旧模型被替换；
+    不再需要时调用 release_diffusion_models() 释放显存。
+    调度器有内部状态，不在此缓存，由各验证器自行创建。
+
+    Returns:
+        (vae, unet, condition_encoder)
+    """
+    # 加载VAE
+    from diffusers import AutoencoderKL
+    vae = AutoencoderKL.from_pretrained(vae_path)
+    vae = vae.to(device)
+    print("  ✅ VAE加载完成")
+
+    # 加载UNet
+    from diffusers import UNet2DConditionModel
+    unet = UNet2DConditionModel.from_pretrained(unet_path)
+    unet = unet.to(device)
+    print("  ✅ UNet加载完成")
+
+    # 加载条件编码器
+    from training.train_diffusion import UserConditionEncoder
+    condition_encoder = UserConditionEncoder(
+        num_users=num_users,
+        embed_dim=unet.config.cross_attention_dim
+    )
+
+    condition_encoder_state = torch.load(condition_encoder_path, map_location='cpu')
+    condition_encoder.load_state_dict(condition_encoder_state)
+    condition_encoder = condition_encoder.to(device)
+    print("  ✅ 条件编码器加载完成")
+
+    if device.startswith("cuda"):
+        # GPU上使用channels_last布局，cuDNN的NHWC卷积kernel访存更连续 (需在编译前转换)
+        unet = unet.to(memory_format=torch.channels_last)
+        vae = vae.to(memory_format=torch.channels_last)
+
+    # 编译采样热路径 (UNet每步调用一次，VAE解码器每批调用一次)
+    if compile_model:
+        torch.set_float32_matmul_precision("high")
+        # reduce-overhead: 每个批次形状首次调用时编译并捕获CUDA Graph，之后直接重放
+        unet = torch.compile(unet, mode="reduce-overhead", fullgraph=False)
+        # 编译内部的decoder模块而不是vae.decode方法，保留AutoencoderKL的包装接口
+        vae.decoder = torch.compile(vae.decoder, mode="reduce-overhead")
+        print("  ⚡ 已启用torch.compile (reduce-overhead)")
+
+    return vae, unet, condition_encoder
+
+# 当前缓存中模型对应的加载参数 (用于在配置变化时提前释放旧模型)
+_cached_model_key = []
+
+def release_diffusion_models():
+    """清空模型缓存并释放显存 (验证器实例不再持有模型时才能真正释放)"""
+    _load_diffusion_models.cache_clear()
+    _cached_model_key.clear()
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+# 各调度器的默认推理步数 (DPM-Solver++约20步即可达到DDIM 50步的质量)
+DEFAULT_INFERENCE_STEPS = {"dpmsolver++": 20, "ddim": 50}
 
 @dataclass
 class ValidationConfig:
@@ -35,11 +131,17 @@ class ValidationConfig:
     classifier_lr: float = 5e-4
     max_samples_per_class: int = 1000
     confidence_threshold: float = 0.8
+    validation_batch_size: int = 32  # 验证生成图像时分类器推理的批次大小
     
     # 生成配置
     num_images_to_generate: int = 100  # 增加到100张，获得更可靠的统计结果
-    num_inference_steps: int = 50  # DDIM推理步数，建议50-200
+    num_inference_steps: Optional[int] = None  # 推理步数，None时按调度器选择 (DPM-Solver++: 20步，DDIM: 50步)
+    scheduler_type: str = "dpmsolver++"  # 推理调度器: "dpmsolver++" 或 "ddim"
     batch_size: int = 10  # 批量生成大小，充分利用显存
+    compile_model: bool = True  # 在CUDA上用torch.compile编译UNet和VAE解码器
+    use_fp16: bool = True  # 在CUDA上用FP16自动混合精度采样
+    use_cuda_graph: bool = False  # 未启用torch.compile时，手动用CUDA Graph重放UNet前向
+    show_training_plot: bool = False  # 同步绘制并显示训练曲线 (默认只在后台保存图片，不弹出显示)
     
     # 模型路径
     vae_path: Optional[str] = None
@@ -48,10 +150,13 @@ class ValidationConfig:
     
     # 设备配置
     device: str = "auto"
+    seed: Optional[int] = 42  # 采样噪声的随机种子 (None表示随机选取，同一验证器内仍按图像序号配对噪声)
     
     def __post_init__(self):
         if self.device == "auto":
             self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        if self.num_inference_steps is None:
+            self.num_inference_steps = DEFAULT_INFERENCE_STEPS.get(self.scheduler_type, 50)
 
 class ConditionalDiffusionValidator:
     """现代化的条件扩散模型验证器 - 参考Diffusers的Pipeline设计"""
@@ -61,6 +166,12 @@ class ConditionalDiffusionValidator:
         self.validation_system = UserValidationSystem(device=config.device)
         self.output_path = Path(config.output_dir)
         self.output_path.mkdir(parents=True, exist_ok=True)
+
+        if str(config.device).startswith("cuda"):
+            # 采样循环形状固定: 让cuDNN自动选择最快的卷积算法；FP32路径允许使用TF32
+            torch.backends.cudnn.benchmark = True
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
         
         # 模型组件 (延迟加载)
         self.vae = None
@@ -68,7 +179,47 @@ class ConditionalDiffusionValidator:
         self.condition_encoder = None
         self.scheduler = None
         self.user_id_mapping = None
+
+        # 手动CUDA Graph缓存 (未启用torch.compile时使用)，按输入形状索引
+        self._unet_compiled = False
+        self._unet_graphs = {}
+
+        # 采样噪声缓冲区和随机数生成器。第i张图像的噪声由 (噪声seed + i) 决定，
+        # 目标用户和各对照条件的第i张图像从同一份噪声出发；未指定seed时随机选一个，
+        # 同一验证器内仍保持配对
+        self._latent_buf = None
+        self._generator = None
+        self._noise_seed = (self.config.seed if self.config.seed is not None
+                            else int.from_bytes(os.urandom(4), "little"))
+
+        # 后台I/O任务 (训练曲线、结果JSON)，流程结束前统一检查
+        self._io_futures = []
         
+    def _submit_io(self, fn, *args, **kwargs):
+        """提交后台I/O任务，失败时立即打印错误，并保留future供流程结束前检查"""
+        future = _io_pool.submit(fn, *args, **kwargs)
+
+        def _log_exception(fut):
+            if not fut.cancelled() and fut.exception() is not None:
+                print(f"❌ 后台I/O任务失败 ({getattr(fn, '__name__', fn)}): {fut.exception()}")
+
+        future.add_done_callback(_log_exception)
+        self._io_futures.append(future)
+        return future
+
+    def _wait_for_io(self) -> List[str]:
+        """等待所有后台I/O任务完成，返回失败任务的错误信息"""
+        errors = []
+        for future in self._io_futures:
+            try:
+                future.result()
+            except Exception as e:
+                import traceback
+                traceback.print_exception(type(e), e, e.__traceback__)
+                errors.append(str(e))
+        self._io_futures.clear()
+        return errors
+
     def load_models(self) -> bool:
         """加载所有必要的模型组件"""
         if not all([self.config.vae_path, self.config.unet_path, self.config.condition_encoder_path]):
@@ -78,37 +229,29 @@ class ConditionalDiffusionValidator:
         try:
             print("📂 加载模型组件...")
             
-            # 加载VAE
-            from diffusers import AutoencoderKL
-            self.vae = AutoencoderKL.from_pretrained(self.config.vae_path)
-            self.vae = self.vae.to(self.config.device)
-            print("  ✅ VAE加载完成")
-            
-            # 加载UNet
-            from diffusers import UNet2DConditionModel
-            self.unet = UNet2DConditionModel.from_pretrained(self.config.unet_path)
-            self.unet = self.unet.to(self.config.device)
-            print("  ✅ UNet加载完成")
-            
             # 获取用户ID映射
             self.user_id_mapping = self._get_user_id_mapping()
             num_users = len(self.user_id_mapping)
             print(f"  📊 用户映射: {self.user_id_mapping}")
-            
-            # 加载条件编码器
-            from training.train_diffusion import UserConditionEncoder
-            self.condition_encoder = UserConditionEncoder(
-                num_users=num_users,
-                embed_dim=self.unet.config.cross_attention_dim
-            )
-            
-            condition_encoder_state = torch.load(self.config.condition_encoder_path, map_location='cpu')
-            self.condition_encoder.load_state_dict(condition_encoder_state)
-            self.condition_encoder = self.condition_encoder.to(self.config.device)
-            print("  ✅ 条件编码器加载完成")
-            
+
+            # 加载VAE/UNet/条件编码器 (同一进程内相同配置的模型直接复用)
+            use_compile = (self.config.compile_model and str(self.config.device).startswith("cuda")
+                           and hasattr(torch, "compile"))
+            model_key = (self.config.vae_path, self.config.unet_path, self.config.condition_encoder_path,
+                         num_users, str(self.config.device), use_compile)
+            if _cached_model_key and _cached_model_key[0] != model_key:
+                # 配置变化: 先释放缓存中的旧模型，避免加载期间两组模型同时占用显存
+                self.vae = self.unet = self.condition_encoder = None
+                release_diffusion_models()
+            cache_hits = _load_diffusion_models.cache_info().hits
+            self.vae, self.unet, self.condition_encoder = _load_diffusion_models(*model_key)
+            _cached_model_key[:] = [model_key]
+            if _load_diffusion_models.cache_info().hits > cache_hits:
+                print("  ♻️  复用已加载的VAE/UNet/条件编码器")
+            self._unet_compiled = use_compile
+
             # 创建调度器 (与训练时一致)
-            from diffusers import DDPMScheduler, DDIMScheduler
+            from diffusers import DDPMScheduler, DDIMScheduler, DPMSolverMultistepScheduler
             noise_scheduler = DDPMScheduler(
                 num_train_timesteps=1000,
                 beta_start=0.00085,
@@ -117,9 +260,15 @@ class ConditionalDiffusionValidator:
                 clip_sample=False,
                 prediction_type="epsilon",
             )
-            # 使用DDIM调度器进行推理 (与训练时生成样本一致)
-            self.scheduler = DDIMScheduler.from_config(noise_scheduler.config)
-            print("  ✅ 调度器创建完成")
+            if self.config.scheduler_type == "ddim":
+                # 使用DDIM调度器进行推理 (与训练时生成样本一致)
+                self.scheduler = DDIMScheduler.from_config(noise_scheduler.config)
+            else:
+                # DPM-Solver++: 基于同一1000步训练调度，约20步即可达到DDIM 50步的质量
+                self.scheduler = DPMSolverMultistepScheduler.from_config(
+                    noise_scheduler.config, algorithm_type="dpmsolver++"
+                )
+            print(f"  ✅ 调度器创建完成 ({self.config.scheduler_type})")
             
             return True
             
@@ -129,28 +278,106 @@ class ConditionalDiffusionValidator:
             traceback.print_exc()
             return False
     
+    def _use_channels_last(self) -> bool:
+        """是否使用channels_last布局 (仅GPU)"""
+        return str(self.config.device).startswith("cuda")
+
+    def _use_cuda_graph(self) -> bool:
+        """是否手动用CUDA Graph执行UNet (torch.compile已经捕获CUDA Graph时不再重复)"""
+        return (self.config.use_cuda_graph and not self._unet_compiled
+                and str(self.config.device).startswith("cuda"))
+
+    def _autocast(self):
+        """采样用的FP16自动混合精度 (仅GPU，UNet/VAE的卷积和注意力走FP16 Tensor Core)"""
+        # CUDA Graph捕获要求关闭autocast的权重类型转换缓存
+        return torch.autocast(device_type="cuda", dtype=torch.float16,
+                              enabled=self.config.use_fp16 and str(self.config.device).startswith("cuda"),
+                              cache_enabled=not self._use_cuda_graph())
+
+    def _unet_forward(self, latents: torch.Tensor, timestep: torch.Tensor,
+                      encoder_hidden_states: torch.Tensor) -> torch.Tensor:
+        """
+        UNet单步噪声预测
+
+        启用 use_cuda_graph 时，每种输入形状首次调用会预热并捕获一张CUDA Graph，
+        之后只需把输入拷进静态缓冲区再重放，省去每步的kernel启动开销。
+        """
+        if not self._use_cuda_graph():
+            return self.unet(latents, timestep, encoder_hidden_states=encoder_hidden_states).sample
+
+        key = (tuple(latents.shape), tuple(encoder_hidden_states.shape))
+        if key not in self._unet_graphs:
+            static = {
+                'latents': latents.clone(),
+                'timestep': timestep.clone(),
+                'encoder_hidden_states': encoder_hidden_states.clone(),
+            }
+
+            # 在旁路流上预热，让cuDNN选好算法、缓存分配器备好显存
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(3):
+                    self.unet(static['latents'], static['timestep'],
+                              encoder_hidden_states=static['encoder_hidden_states'])
+            torch.cuda.current_stream().wait_stream(stream)
+
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                static['output'] = self.unet(static['latents'], static['timestep'],
+                                             encoder_hidden_states=static['encoder_hidden_states']).sample
+            self._unet_graphs[key] = (graph, static)
+
+        graph, static = self._unet_graphs[key]
+        static['latents'].copy_(latents)
+        static['timestep'].copy_(timestep)
+        static['encoder_hidden_states'].copy_(encoder_hidden_states)
+        graph.replay()
+        # 输出缓冲区会在下次重放时被覆盖，返回副本
+        return static['output'].clone()
+
     def _get_user_id_mapping(self) -> Dict[int, int]:
         """获取用户ID映射 - 与训练时保持一致，并进行一致性检查"""
         data_path = Path(self.config.real_data_root)
-        all_users = []
 
         print(f"  🔍 扫描数据目录: {data_path}")
 
-        for user_dir in data_path.iterdir():
-            if user_dir.is_dir() and user_dir.name.startswith('ID_'):
+        user_dirs = sorted(d for d in data_path.iterdir() if d.is_dir() and d.name.startswith('ID_'))
+
+        # 映射缓存: 以用户目录名及其mtime为键，目录增删或图像变化后自动失效
+        key_source = repr([(d.name, d.stat().st_mtime_ns) for d in user_dirs])
+        cache_key = hashlib.md5(key_source.encode()).hexdigest()
+        cache_path = self.output_path / ".user_id_cache.json"
+        image_counts = None
+        if cache_path.exists():
+            try:
+                with open(cache_path, 'r', encoding='utf-8') as f:
+                    cache = json.load(f)
+                if cache.get('key') == cache_key:
+                    image_counts = {int(user_id): count for user_id, count in cache['image_counts'].items()}
+                    print(f"    ♻️  使用缓存的用户扫描结果")
+            except Exception as e:
+                print(f"    ⚠️  读取用户映射缓存失败，重新扫描: {e}")
+
+        if image_counts is None:
+            image_counts = {}
+            for user_dir in user_dirs:
                 try:
                     user_id = int(user_dir.name.split('_')[1])
-                    all_users.append(user_id)
-
-                    # 检查图像数量
-                    image_files = list(user_dir.glob("*.png")) + list(user_dir.glob("*.jpg"))
-                    print(f"    ID_{user_id:2d}: {len(image_files):3d} 张图像")
-
                 except ValueError:
                     print(f"    ⚠️  无效目录名: {user_dir.name}")
                     continue
 
-        all_users = sorted(all_users)
+                # 检查图像数量
+                image_counts[user_id] = len(list_image_files(user_dir))
+
+            with open(cache_path, 'w', encoding='utf-8') as f:
+                json.dump({'key': cache_key, 'image_counts': image_counts}, f)
+
+        for user_id, count in sorted(image_counts.items()):
+            print(f"    ID_{user_id:2d}: {count:3d} 张图像")
+
+        all_users = sorted(image_counts)
         user_mapping = {user_id: idx for idx, user_id in enumerate(all_users)}
 
         print(f"  📊 用户映射 (训练时一致): {user_mapping}")
@@ -187,7 +414,10 @@ class ConditionalDiffusionValidator:
             
             # 保存训练曲线
             plot_path = self.output_path / f"user_{self.config.target_user_id:02d}_training.png"
-            self.validation_system.plot_training_history(history, str(plot_path))
+            if self.config.show_training_plot:
+                self.validation_system.plot_training_history(history, str(plot_path))
+            else:
+                self._submit_io(self.validation_system.plot_training_history, history, str(plot_path), show=False)
             
             # 检查训练效果
             best_val_acc = max(history['val_acc'])
@@ -224,15 +454,53 @@ class ConditionalDiffusionValidator:
             print(f"❌ 未找到用户 {self.config.target_user_id} 的数据目录")
             return [], []
 
+        negative_ratio = 3.0  # 负样本是正样本的3倍
+
+        # 目录扫描缓存: 固定的JSON文件，按目录保存 [mtime_ns, 文件列表]，
+        # 只重新扫描mtime变化的目录并原地覆盖；负样本采样仍在每次调用时重新进行
+        other_user_dirs = sorted(other_user_dirs)
+        cache_path = self.output_path / ".scan_cache.json"
+        cache = {}
+        if cache_path.exists():
+            try:
+                with open(cache_path, 'r', encoding='utf-8') as f:
+                    cache = json.load(f)
+            except Exception as e:
+                print(f"  ⚠️  读取扫描缓存失败，重新扫描: {e}")
+                cache = {}
+
+        file_lists = {}
+        stale_count = 0
+        for d in [target_user_dir] + other_user_dirs:
+            mtime_ns = d.stat().st_mtime_ns
+            entry = cache.get(str(d))
+            if entry is None or entry[0] != mtime_ns:
+                entry = [mtime_ns, list_image_files(d)]
+                cache[str(d)] = entry
+                stale_count += 1
+            file_lists[str(d)] = entry[1]
+
+        if stale_count:
+            with open(cache_path, 'w', encoding='utf-8') as f:
+                json.dump(cache, f)
+            # 清理旧版本按键名分文件保存的pickle缓存
+            for old_cache in self.output_path.glob(".scan_cache_*.pkl"):
+                old_cache.unlink(missing_ok=True)
+        else:
+            print(f"  ♻️  使用缓存的目录扫描结果: {len(file_lists)} 个目录")
+
         # 使用改进的数据准备方法
-        return self.validation_system.prepare_user_data(
+        image_paths, labels = self.validation_system.prepare_user_data(
             user_id=self.config.target_user_id,
             real_images_dir=str(target_user_dir),
             other_users_dirs=[str(d) for d in other_user_dirs],
             max_samples_per_class=self.config.max_samples_per_class,
-            negative_ratio=3.0  # 负样本是正样本的3倍
+            negative_ratio=negative_ratio,
+            file_lists=file_lists
         )
 
+        return image_paths, labels
+
     def generate_images(self) -> Optional[str]:
         """生成指定用户的图像"""
         if not all([self.vae, self.unet, self.condition_encoder, self.scheduler]):
@@ -254,15 +522,12 @@ class ConditionalDiffusionValidator:
             # 获取用户索引
             user_idx = self.user_id_mapping[self.config.target_user_id]
 
-            # 设置调度器
-            self.scheduler.set_timesteps(self.config.num_inference_steps)
-
-            # 生成图像
+            # 生成图像 (固定seed，结果可复现)
             self.vae.eval()
             self.unet.eval()
             self.condition_encoder.eval()
 
-            with torch.no_grad():
+            with torch.inference_mode():
                 # 批量生成配置
                 batch_size = self.config.batch_size  # 使用配置中的批量大小
                 total_images = self.config.num_images_to_generate
@@ -276,48 +541,19 @@ class ConditionalDiffusionValidator:
                     current_batch_size = min(batch_size, total_images - batch_idx * batch_size)
                     print(f"  🎨 生成批次 {batch_idx+1}/{num_batches} ({current_batch_size}张)...")
 
-                    # 批量随机噪声
-                    latents = torch.randn(current_batch_size, 4, 32, 32, device=self.config.device)
-
-                    # 批量用户条件
-                    user_tensor = torch.tensor([user_idx] * current_batch_size, device=self.config.device)
-                    user_embedding = self.condition_encoder(user_tensor)
-
-                    # 确保3D张量格式
-                    if user_embedding.dim() == 2:
-                        user_embedding = user_embedding.unsqueeze(1)
-
-                    # 扩散过程
-                    latents = latents * self.scheduler.init_noise_sigma
-
-                    for t in self.scheduler.timesteps:
-                        # 批量纯条件预测 (与训练时相同)
-                        noise_pred = self.unet(
-                            latents,
-                            t,
-                            encoder_hidden_states=user_embedding
-                        ).sample
-
-                        # 调度器步骤
-                        latents = self.scheduler.step(noise_pred, t, latents).prev_sample
-
-                    # 批量解码为图像
-                    vae_model = self.vae.module if hasattr(self.vae, 'module') else self.vae
-                    latents = latents / vae_model.config.scaling_factor
-                    images = vae_model.decode(latents).sample
-                    images = images.clamp(0, 1)
+                    # 整批共享一个去噪循环 (与训练时相同的纯条件生成)
+                    images = self._sample_images(
+                        [user_idx] * current_batch_size,
+                        noise_indices=list(range(image_count, image_count + current_batch_size))
+                    )
 
                     # 批量保存图像
-                    from PIL import Image
-                    batch_images = images.cpu().permute(0, 2, 3, 1).numpy()
-
-                    for i in range(current_batch_size):
-                        image = (batch_images[i] * 255).astype(np.uint8)
-                        pil_image = Image.fromarray(image)
-
-                        save_path = gen_output_dir / f"user_{self.config.target_user_id}_generated_{image_count+1:02d}.png"
-                        pil_image.save(save_path)
-                        image_count += 1
+                    save_paths = [
+                        gen_output_dir / f"user_{self.config.target_user_id}_generated_{image_count+i+1:02d}.png"
+                        for i in range(current_batch_size)
+                    ]
+                    self._save_images(self._to_uint8_images(images), save_paths)
+                    image_count += current_batch_size
 
             print(f"  ✅ 生成完成，保存在: {gen_output_dir}")
             return str(gen_output_dir)
@@ -333,15 +569,23 @@ class ConditionalDiffusionValidator:
         print(f"\n🔍 验证生成图像 (改进版本)")
 
         try:
+            # 只列出一次生成图像，后续验证复用同一列表
+            gen_dir = Path(generated_images_dir)
+            if not gen_dir.exists():
+                raise FileNotFoundError(f"生成图像目录不存在: {gen_dir}")
+            image_files = sorted(list_image_files(gen_dir))
+
             # 1. 原有的分类器验证
             basic_result = self.validation_system.validate_generated_images(
                 user_id=self.config.target_user_id,
                 generated_images_dir=generated_images_dir,
-                confidence_threshold=self.config.confidence_threshold
+                confidence_threshold=self.config.confidence_threshold,
+                image_files=image_files,
+                batch_size=self.config.validation_batch_size
             )
 
-            # 2. 对比控制实验
-            control_result = self._controlled_validation_experiment(generated_images_dir)
+            # 2. 对比控制实验 (正确条件的结果直接复用基础验证)
+            control_result = self._controlled_validation_experiment(generated_images_dir, basic_result)
 
             # 3. 全用户对比矩阵验证（可选，更全面）
             matrix_result = self._full_user_matrix_validation()
@@ -356,8 +600,7 @@ class ConditionalDiffusionValidator:
 
             # 保存验证结果
             result_path = self.output_path / f"user_{self.config.target_user_id:02d}_validation.json"
-            with open(result_path, 'w') as f:
-                json.dump(result, f, indent=2)
+            self._submit_io(_dump_json, copy.deepcopy(result), result_path)
 
             return result
 
@@ -367,8 +610,14 @@ class ConditionalDiffusionValidator:
             traceback.print_exc()
             return {}
 
-    def _controlled_validation_experiment(self, generated_images_dir: str) -> Dict:
-        """对比控制实验 - 验证条件生成的有效性"""
+    def _controlled_validation_experiment(self, generated_images_dir: str,
+                                          correct_result: Optional[Dict] = None) -> Dict:
+        """对比控制实验 - 验证条件生成的有效性
+
+        Args:
+            generated_images_dir: 正确条件生成的图像目录
+            correct_result: 已有的正确条件验证结果，提供时不再重复验证该目录
+        """
         print(f"  🧪 执行对比控制实验...")
 
         try:
@@ -387,30 +636,29 @@ class ConditionalDiffusionValidator:
 
             control_results = {}
 
-            # 2. 为每个错误用户ID生成图像并验证
-            for wrong_id in wrong_user_ids:
-                print(f"    生成错误条件图像 (用户{wrong_id})...")
+            # 2. 一次性为所有错误用户ID生成图像，再逐个验证
+            wrong_images_dirs = self._generate_condition_images(wrong_user_ids)
 
-                # 生成错误条件的图像
-                wrong_images_dir = self._generate_wrong_condition_images(wrong_id)
-
-                if wrong_images_dir:
-                    # 用目标用户的分类器验证错误条件图像
-                    wrong_result = self.validation_system.validate_generated_images(
-                        user_id=self.config.target_user_id,
-                        generated_images_dir=wrong_images_dir,
-                        confidence_threshold=self.config.confidence_threshold
-                    )
-                    control_results[f'wrong_user_{wrong_id}'] = wrong_result
+            for wrong_id, wrong_images_dir in wrong_images_dirs.items():
+                # 用目标用户的分类器验证错误条件图像
+                wrong_result = self.validation_system.validate_generated_images(
+                    user_id=self.config.target_user_id,
+                    generated_images_dir=wrong_images_dir,
+                    confidence_threshold=self.config.confidence_threshold,
+                    batch_size=self.config.validation_batch_size
+                )
+                control_results[f'wrong_user_{wrong_id}'] = wrong_result
 
             # 3. 计算对比指标
             if control_results:
                 # 正确条件的结果
-                correct_result = self.validation_system.validate_generated_images(
-                    user_id=self.config.target_user_id,
-                    generated_images_dir=generated_images_dir,
-                    confidence_threshold=self.config.confidence_threshold
-                )
+                if correct_result is None:
+                    correct_result = self.validation_system.validate_generated_images(
+                        user_id=self.config.target_user_id,
+                        generated_images_dir=generated_images_dir,
+                        confidence_threshold=self.config.confidence_threshold,
+                        batch_size=self.config.validation_batch_size
+                    )
 
                 correct_success_rate = correct_result.get('success_rate', 0)
                 wrong_success_rates = [r.get('success_rate', 0) for r in control_results.values()]
@@ -433,75 +681,155 @@ class ConditionalDiffusionValidator:
             print(f"    ❌ 对比实验失败: {e}")
             return {'error': str(e)}
 
-    def _generate_wrong_condition_images(self, wrong_user_id: int, num_images: int = 4) -> str:
-        """生成错误条件的图像用于对比"""
-        try:
-            # 创建错误条件图像的输出目录
-            wrong_dir = self.output_path / "control_images" / f"wrong_user_{wrong_user_id}"
-            wrong_dir.mkdir(parents=True, exist_ok=True)
-
-            # 获取错误用户的索引
-            wrong_user_idx = self.user_id_mapping[wrong_user_id]
-
-            # 设置调度器
-            self.scheduler.set_timesteps(self.config.num_inference_steps)
+    def _sample_images(self, user_indices: List[int], noise_indices: List[int]) -> torch.Tensor:
+        """
+        对一组用户索引执行一次批量采样
+
+        每个样本使用各自的用户条件，不同用户的图像共享同一个去噪循环。
+        训练时没有条件丢弃，这里不使用无分类器引导 (CFG)，每步只做一次条件UNet前向。
+
+        Args:
+            user_indices: 每个样本对应的用户索引 (映射后的索引)
+            noise_indices: 每个样本的图像序号，序号相同的样本使用相同的初始噪声
+
+        Returns:
+            [0,1]范围的图像张量 (N, 3, H, W)
+        """
+        # 每次采样前重新设置调度器 (多步调度器会保存上一轮的中间结果)
+        self.scheduler.set_timesteps(self.config.num_inference_steps)
+
+        # 批量随机噪声: 复用常驻的噪声缓冲区，每个样本按 (噪声seed + 图像序号) 原地填充，
+        # 与批次划分和条件无关，不同条件的同一序号样本从相同的噪声出发
+        num_samples = len(user_indices)
+        if self._latent_buf is None or self._latent_buf.shape[0] < num_samples:
+            memory_format = torch.channels_last if self._use_channels_last() else torch.contiguous_format
+            self._latent_buf = torch.empty(num_samples, 4, 32, 32, device=self.config.device,
+                                           memory_format=memory_format)
+        if self._generator is None:
+            self._generator = torch.Generator(device=self.config.device)
+        latents = self._latent_buf[:num_samples]
+        for k, noise_idx in enumerate(noise_indices):
+            self._generator.manual_seed(self._noise_seed + noise_idx)
+            latents[k].normal_(generator=self._generator)
+
+        with self._autocast():
+            # 批量用户条件: 每个不同的用户只编码一次，再按样本展开为 (N, 1, D)
+            user_tensor = torch.tensor(user_indices, device=self.config.device)
+            unique_users, sample_to_user = torch.unique(user_tensor, return_inverse=True)
+            user_embedding = self.condition_encoder(unique_users)
+
+            # 确保3D张量格式
+            if user_embedding.dim() == 2:
+                user_embedding = user_embedding.unsqueeze(1)
+            user_embedding = user_embedding[sample_to_user]
+
+            # 扩散过程
+            latents = latents * self.scheduler.init_noise_sigma
+
+            # 条件嵌入已在循环外算好；时间步也提前一次性拷到设备上，
+            # 避免UNet每步都把CPU上的时间步拷贝到GPU (调度器仍使用CPU上的t)
+            unet_timesteps = self.scheduler.timesteps.to(self.config.device)
+
+            for i, t in enumerate(self.scheduler.timesteps):
+                # 批量纯条件预测
+                noise_pred = self._unet_forward(
+                    latents,
+                    unet_timesteps[i],
+                    encoder_hidden_states=user_embedding
+                )
 
-            # 生成图像
+                # 调度器步骤 (在FP32下进行，latents始终保持FP32)
+                latents = self.scheduler.step(noise_pred.float(), t, latents).prev_sample
+
+            # 批量解码为图像
+            vae_model = self.vae.module if hasattr(self.vae, 'module') else self.vae
+            latents = latents / vae_model.config.scaling_factor
+            images = vae_model.decode(latents).sample
+        # VAE以[0,1]范围的图像训练 (数据只经过ToTensor，没有归一化到[-1,1])，直接截断到[0,1]。
+        # 解码结果已是FP32时.float()返回同一张量 (编译后可能是CUDA Graph的静态输出缓冲区)，
+        # 不能原地修改，需非原地截断；FP16时.float()已生成新张量，可以原地截断。
+        # 两种情况下返回的都是调用方独占的新张量
+        if images.dtype == torch.float32:
+            return images.clamp(0, 1)
+        return images.float().clamp_(0, 1)
+
+    @staticmethod
+    def _to_uint8_images(images: torch.Tensor) -> np.ndarray:
+        """
+        把[0,1]范围的图像批次转换为连续的uint8 NHWC数组
+
+        缩放、类型转换和布局转换都在设备上完成，整批只做一次设备到主机的拷贝，
+        传给输出的数组只有原来float32数据量的1/4。
+        缩放会原地修改传入的张量，只能传入调用方独占的张量 (如 _sample_images 的返回值)。
+        """
+        images = images.mul_(255).to(torch.uint8).permute(0, 2, 3, 1).contiguous()
+        return images.cpu().numpy()
+
+    @staticmethod
+    def _save_images(images: np.ndarray, save_paths: List[Path]):
+        """
+        多线程保存一批uint8图像为PNG
+
+        PIL在PNG压缩时会释放GIL，多个线程可以并行编码；
+        compress_level=1 大幅减少zlib压缩耗时，文件只略微变大。
+        """
+        from PIL import Image
+
+        def save(item):
+            image, save_path = item
+            Image.fromarray(image).save(save_path, compress_level=1)
+
+        with ThreadPoolExecutor(max_workers=min(8, len(save_paths))) as executor:
+            list(executor.map(save, zip(images, save_paths)))
+
+    def _generate_condition_images(self, user_ids: List[int], num_images: int = 4) -> Dict[int, str]:
+        """
+        为多个用户条件生成对比图像
+
+        所有用户的样本合并后按 batch_size 分批采样，
+        避免每个用户单独跑一遍完整的去噪循环。
+
+        Returns:
+            {用户ID: 图像目录}，生成失败时返回空字典
+        """
+        try:
+            # 生成图像 (第i张与目标用户的第i张使用相同的初始噪声，只有条件不同)
             self.vae.eval()
             self.unet.eval()
             self.condition_encoder.eval()
 
-            with torch.no_grad():
-                # 对比实验也使用批量生成（数量较少，一次性生成）
-                print(f"    批量生成{num_images}张对比图像...")
-
-                # 批量随机噪声
-                latents = torch.randn(num_images, 4, 32, 32, device=self.config.device)
-
-                # 批量错误用户条件
-                user_tensor = torch.tensor([wrong_user_idx] * num_images, device=self.config.device)
-                user_embedding = self.condition_encoder(user_tensor)
-
-                # 确保3D张量格式
-                if user_embedding.dim() == 2:
-                    user_embedding = user_embedding.unsqueeze(1)
-
-                # 扩散过程
-                latents = latents * self.scheduler.init_noise_sigma
-
-                for t in self.scheduler.timesteps:
-                    # 批量纯条件预测
-                    noise_pred = self.unet(
-                        latents,
-                        t,
-                        encoder_hidden_states=user_embedding
-                    ).sample
-
-                    # 调度器步骤
-                    latents = self.scheduler.step(noise_pred, t, latents).prev_sample
-
-                # 批量解码为图像
-                vae_model = self.vae.module if hasattr(self.vae, 'module') else self.vae
-                latents = latents / vae_model.config.scaling_factor
-                images = vae_model.decode(latents).sample
-                images = images.clamp(0, 1)
-
-                # 批量保存图像
-                from PIL import Image
-                batch_images = images.cpu().permute(0, 2, 3, 1).numpy()
-
-                for i in range(num_images):
-                    image = (batch_images[i] * 255).astype(np.uint8)
-                    pil_image = Image.fromarray(image)
+            # 每个样本对应的 (用户ID, 图像序号)
+            samples = [(user_id, i) for user_id in user_ids for i in range(num_images)]
+            image_dirs = {}
+            for user_id in user_ids:
+                # 创建错误条件图像的输出目录
+                wrong_dir = self.output_path / "control_images" / f"wrong_user_{user_id}"
+                wrong_dir.mkdir(parents=True, exist_ok=True)
+                image_dirs[user_id] = wrong_dir
+
+            print(f"    批量生成{len(samples)}张对比图像 ({len(user_ids)}个用户 × {num_images}张)...")
+
+            batch_size = self.config.batch_size
+            with torch.inference_mode():
+                for start in range(0, len(samples), batch_size):
+                    batch_samples = samples[start:start + batch_size]
+                    images = self._sample_images(
+                        [self.user_id_mapping[user_id] for user_id, _ in batch_samples],
+                        noise_indices=[i for _, i in batch_samples]
+                    )
 
-                    save_path = wrong_dir / f"wrong_condition_{i+1:02d}.png"
-                    pil_image.save(save_path)
+                    # 批量保存图像
+                    save_paths = [
+                        image_dirs[user_id] / f"wrong_condition_{i+1:02d}.png"
+                        for user_id, i in batch_samples
+                    ]
+                    self._save_images(self._to_uint8_images(images), save_paths)
 
-            return str(wrong_dir)
+            return {user_id: str(image_dir) for user_id, image_dir in image_dirs.items()}
 
         except Exception as e:
             print(f"    ❌ 生成错误条件图像失败: {e}")
-            return None
+            return {}
 
     def _full_user_matrix_validation(self) -> Dict:
         """全用户对比矩阵验证 - 最严格的验证方法"""
@@ -518,13 +846,8 @@ class ConditionalDiffusionValidator:
 
             print(f"    为所有{len(all_users)}个用户生成图像并交叉验证...")
 
-            # 生成所有用户的图像
-            user_images = {}
-            for user_id in all_users:
-                print(f"      生成用户{user_id}的图像...")
-                images_dir = self._generate_wrong_condition_images(user_id, num_images=2)
-                if images_dir:
-                    user_images[user_id] = images_dir
+            # 一次性生成所有用户的图像
+            user_images = self._generate_condition_images(all_users, num_images=2)
 
             # 用目标用户的分类器验证所有生成图像
             validation_matrix = {}
@@ -532,7 +855,8 @@ class ConditionalDiffusionValidator:
                 result = self.validation_system.validate_generated_images(
                     user_id=target_user,  # 始终用目标用户的分类器
                     generated_images_dir=images_dir,
-                    confidence_threshold=self.config.confidence_threshold
+                    confidence_threshold=self.config.confidence_threshold,
+                    batch_size=self.config.validation_batch_size
                 )
                 validation_matrix[generated_user_id] = result.get('success_rate', 0)
 
@@ -619,6 +943,16 @@ class ConditionalDiffusionValidator:
 
         return result
 
+    def _move_classifiers(self, device):
+        """在流程阶段之间移动已训练的分类器 (保留权重，只改变所在设备)"""
+        for model in self.validation_system.classifiers.values():
+            model.to(device)
+        if str(device) == "cpu":
+            # 阶段切换时把释放的显存还给驱动，供下一阶段的大批次使用
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
     def run_full_pipeline(self, generate_images: bool = True) -> Dict:
         """运行完整的验证流程"""
         print(f"🚀 开始完整验证流程")
@@ -638,6 +972,7 @@ class ConditionalDiffusionValidator:
         # 步骤1: 训练分类器
         if not self.train_classifier():
             print("❌ 分类器训练失败，终止流程")
+            self._finish_io(results)
             return results
 
         results["classifier_trained"] = True
@@ -645,6 +980,8 @@ class ConditionalDiffusionValidator:
         # 步骤2: 生成图像 (可选)
         generated_dir = None
         if generate_images:
+            # 生成期间分类器不参与计算，先移到CPU，把显存留给VAE和UNet
+            self._move_classifiers("cpu")
             if not self.load_models():
                 print("❌ 模型加载失败，跳过图像生成")
             else:
@@ -654,6 +991,8 @@ class ConditionalDiffusionValidator:
                     results["generated_images_dir"] = generated_dir
 
         # 步骤3: 验证图像
+        # 扩散模型保持常驻: 对比实验在验证阶段还需要继续采样
+        self._move_classifiers(self.validation_system.device)
         if generated_dir:
             validation_result = self.validate_generated_images(generated_dir)
             if validation_result:
@@ -671,8 +1010,17 @@ class ConditionalDiffusionValidator:
                     print(f"⚠️  验证结果不理想. 成功率: {success_rate:.2f}, 平均置信度: {avg_confidence:.3f}")
                     print(f"💡 建议: 尝试更多推理步数 (num_inference_steps > {self.config.num_inference_steps})")
 
+        self._finish_io(results)
         return results
 
+    def _finish_io(self, results: Dict):
+        """流程结束前等待后台I/O，写入失败时记录到结果中并标记失败"""
+        io_errors = self._wait_for_io()
+        if io_errors:
+            results["io_errors"] = io_errors
+            results["success"] = False
+            print(f"❌ {len(io_errors)} 个后台I/O任务失败，验证结果未完整保存")
+
 def main():
     """主函数 - 现代化的命令行接口"""
     parser = argparse.ArgumentParser(
@@ -691,6 +1039,8 @@ def main():
                        help="输出目录")
     parser.add_argument("--device", type=str, default="auto",
                        help="计算设备 (auto/cuda/cpu)")
+    parser.add_argument("--seed", type=int, default=42,
+                       help="采样噪声的随机种子")
 
     # 分类器配置
     parser.add_argument("--classifier_epochs", type=int, default=30,
@@ -703,6 +1053,8 @@ def main():
                        help="每类最大样本数")
     parser.add_argument("--confidence_threshold", type=float, default=0.8,
                        help="置信度阈值")
+    parser.add_argument("--validation_batch_size", type=int, default=32,
+                       help="验证生成图像时分类器推理的批次大小")
 
 
     # 生成配置
@@ -710,10 +1062,20 @@ def main():
                        help="是否生成图像")
     parser.add_argument("--num_images_to_generate", type=int, default=100,
                        help="生成图像数量 (建议100+张获得可靠统计结果)")
-    parser.add_argument("--num_inference_steps", type=int, default=50,
-                       help="DDIM推理步数 (建议50-200)")
+    parser.add_argument("--num_inference_steps", type=int, default=None,
+                       help="推理步数 (默认按调度器选择: DPM-Solver++为20，DDIM为50)")
+    parser.add_argument("--scheduler", type=str, default="dpmsolver++", choices=["dpmsolver++", "ddim"],
+                       help="推理调度器")
     parser.add_argument("--batch_size", type=int, default=10,
                        help="批量生成大小 (根据显存调整，建议8-16)")
+    parser.add_argument("--disable_compile", action="store_true",
+                       help="禁用torch.compile (调试或编译失败时使用)")
+    parser.add_argument("--disable_fp16", action="store_true",
+                       help="禁用FP16混合精度采样 (全程FP32)")
+    parser.add_argument("--use_cuda_graph", action="store_true",
+                       help="未启用torch.compile时，手动用CUDA Graph重放UNet前向")
+    parser.add_argument("--show_training_plot", action="store_true",
+                       help="同步绘制并显示分类器训练曲线 (默认只在后台保存图片)")
 
     # 模型路径
     parser.add_argument("--vae_path", type=str,
@@ -735,13 +1097,20 @@ def main():
         classifier_lr=args.classifier_lr,
         max_samples_per_class=args.max_samples_per_class,
         confidence_threshold=args.confidence_threshold,
+        validation_batch_size=args.validation_batch_size,
         num_images_to_generate=args.num_images_to_generate,
         num_inference_steps=args.num_inference_steps,
+        scheduler_type=args.scheduler,
         batch_size=args.batch_size,
+        compile_model=not args.disable_compile,
+        use_fp16=not args.disable_fp16,
+        use_cuda_graph=args.use_cuda_graph,
+        show_training_plot=args.show_training_plot,
         vae_path=args.vae_path,
         unet_path=args.unet_path,
         condition_encoder_path=args.condition_encoder_path,
-        device=args.device
+        device=args.device,
+        seed=args.seed
     )
 
     # 打印配置
@@ -758,6 +1127,8 @@ def main():
     # 创建验证器并运行
     validator = ConditionalDiffusionValidator(config)
     results = validator.run_full_pipeline(generate_images=args.generate_images)
+    del validator
+    release_diffusion_models()
 
     # 输出结果
     print(f"\n📋 验证结果总结:")
@@ -769,8 +1140,7 @@ def main():
 
     # 保存完整结果
     result_file = Path(config.output_dir) / f"user_{config.target_user_id:02d}_complete_results.json"
-    with open(result_file, 'w') as f:
-        json.dump(results, f, indent=2, default=str)
+    _dump_json(results, result_file)
 
     print(f"\n📄 完整结果保存在: {result_file}")
 